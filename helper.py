@@ -3,11 +3,17 @@
 Mumble Link Helper for Foundry VTT
 This helper application bridges the gap between the web-based FVTT and Mumble's Link plugin
 by providing a WebSocket server that can write to the memory-mapped file.
+
+The packing hot path is deliberately kept pure Python: the cached Struct
+objects already do the heavy lifting in C, and staying a single
+dependency-light script means users can run it with a stock Python install.
 """
 
 import asyncio
+import ctypes
 import json
 import mmap
+import os
 import struct
 import websockets
 import logging
@@ -15,15 +21,55 @@ from pathlib import Path
 import sys
 import platform
 
+# orjson parses several times faster than the stdlib and takes bytes
+# directly, but keep it optional so the helper runs without it
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Pre-compiled Struct objects for the fixed-layout numeric fields, so the
+# format strings are parsed once instead of on every update
+_HEADER = struct.Struct('<II3f3f3f')  # uiVersion, uiTick, avatar pos/front/top
+_CAM = struct.Struct('<9f')           # camera pos/front/top
+_CTXLEN = struct.Struct('<I')         # context_len
+_TICK = struct.Struct('<I')           # uiTick alone, for unchanged-data updates
+
+# The uid never changes over the helper's lifetime (no getuid on Windows)
+_UID = os.getuid() if hasattr(os, 'getuid') else 0
+
+# Zero source for re-blanking the variable-length string regions; slicing a
+# memoryview is copy-free
+_ZEROS = memoryview(bytes(684))
+
+# Shared defaults for absent fields; tuples so no per-message allocation
+_DEF_POS = (0.0, 0.0, 0.0)
+_DEF_FRONT = (0.0, 0.0, 1.0)
+_DEF_TOP = (0.0, 1.0, 0.0)
+
 class MumbleLinkHelper:
-    def __init__(self):
-        self.clients = set()
+    def __init__(self, flush=False):
+        self._do_flush = flush
+        self._is_windows = platform.system() == "Windows"
         self.mumble_link = None
+        self.mumble_memory = None
+        self._mm_view = None
         self.link_name = self._get_link_name()
+        self._tick = 0
+        # Last seen string -> encoded bytes per field; name/identity/
+        # description rarely change between ticks
+        self._str_cache = {}
+        # Field values from the previous update, to skip repacking when
+        # nothing has moved
+        self._last_sig = None
+        # Latest undelivered update; the flusher task drains it at ~60Hz
+        # so bursts of messages coalesce into one mmap write
+        self._pending = None
         
     def _get_link_name(self):
         """Get the appropriate memory-mapped file name for the current platform"""
@@ -31,9 +77,9 @@ class MumbleLinkHelper:
         if system == "Windows":
             return "MumbleLink"
         elif system == "Linux":
-            return "/dev/shm/MumbleLink.{uid}".format(uid=os.getuid())
+            return f"/dev/shm/MumbleLink.{_UID}"
         elif system == "Darwin":  # macOS
-            return "/tmp/MumbleLink.{uid}".format(uid=os.getuid())
+            return f"/tmp/MumbleLink.{_UID}"
         else:
             logger.error(f"Unsupported platform: {system}")
             return None
@@ -41,13 +87,16 @@ class MumbleLinkHelper:
     async def initialize_mumble_link(self):
         """Initialize connection to Mumble Link plugin"""
         try:
-            if platform.system() == "Windows":
+            if self._is_windows:
                 # On Windows, we need to use CreateFileMapping/MapViewOfFile
-                import ctypes
                 from ctypes import wintypes
-                
+
                 kernel32 = ctypes.windll.kernel32
-                
+                # Default restype is a C int, which truncates 64-bit
+                # handles and pointers
+                kernel32.OpenFileMappingW.restype = wintypes.HANDLE
+                kernel32.MapViewOfFile.restype = ctypes.c_void_p
+
                 # Try to open existing mapping
                 handle = kernel32.OpenFileMappingW(
                     0x1F,  # FILE_MAP_ALL_ACCESS
@@ -67,7 +116,12 @@ class MumbleLinkHelper:
                 if not self.mumble_memory:
                     logger.error("Failed to map Mumble Link memory")
                     return False
-                    
+
+                # Wrap the raw pointer so fields can be packed into the
+                # mapping in place, same as the POSIX path
+                self._win_buf = (ctypes.c_char * 2048).from_address(self.mumble_memory)
+                self._mm_view = memoryview(self._win_buf).cast('B')
+
             else:
                 # Unix-like systems
                 if not Path(self.link_name).exists():
@@ -75,8 +129,20 @@ class MumbleLinkHelper:
                     return False
                     
                 with open(self.link_name, 'r+b') as f:
-                    self.mumble_memory = mmap.mmap(f.fileno(), 2048)
-            
+                    # MAP_POPULATE (Linux) faults the page in up front
+                    flags = mmap.MAP_SHARED
+                    if hasattr(mmap, 'MAP_POPULATE'):
+                        flags |= mmap.MAP_POPULATE
+                    self.mumble_memory = mmap.mmap(f.fileno(), 2048, flags=flags)
+
+                # Touch the page now so the first update doesn't stall the
+                # event loop on a page fault; rewrite byte 0 with itself to
+                # leave whatever Mumble has there intact
+                self.mumble_memory[0:1] = bytes(self.mumble_memory[0:1])
+
+                # Pack straight into the mapping; no staging copy needed
+                self._mm_view = memoryview(self.mumble_memory)
+
             logger.info("Successfully connected to Mumble Link")
             return True
             
@@ -84,9 +150,19 @@ class MumbleLinkHelper:
             logger.error(f"Failed to initialize Mumble Link: {e}")
             return False
 
+    def _wenc(self, key, s, max_bytes):
+        """UTF-16LE encode ``s``, reusing the cached bytes when the string
+        for this field is unchanged since the last update"""
+        cached = self._str_cache.get(key)
+        if cached is not None and cached[0] == s:
+            return cached[1]
+        encoded = s.encode('utf-16le')[:max_bytes]
+        self._str_cache[key] = (s, encoded)
+        return encoded
+
     def update_mumble_link(self, data):
         """Update the Mumble Link memory with position data"""
-        if not self.mumble_memory:
+        if self._mm_view is None:
             return
             
         try:
@@ -107,116 +183,129 @@ class MumbleLinkHelper:
             #     wchar_t description[2048];
             # };
             
-            # Start building the binary data
-            binary_data = bytearray(2048)
-            offset = 0
-            
-            # uiVersion (4 bytes)
-            struct.pack_into('<I', binary_data, offset, data.get('uiVersion', 4))
-            offset += 4
-            
-            # uiTick (4 bytes) - increment counter
-            tick = struct.unpack_from('<I', binary_data, offset)[0] + 1
-            struct.pack_into('<I', binary_data, offset, tick)
-            offset += 4
-            
-            # Avatar position (12 bytes - 3 floats)
-            pos = data.get('fAvatarPosition', [0, 0, 0])
-            for i in range(3):
-                struct.pack_into('<f', binary_data, offset, pos[i])
-                offset += 4
-                
-            # Avatar front (12 bytes - 3 floats)
-            front = data.get('fAvatarFront', [0, 0, 1])
-            for i in range(3):
-                struct.pack_into('<f', binary_data, offset, front[i])
-                offset += 4
-                
-            # Avatar top (12 bytes - 3 floats)
-            top = data.get('fAvatarTop', [0, 1, 0])
-            for i in range(3):
-                struct.pack_into('<f', binary_data, offset, top[i])
-                offset += 4
-            
-            # Name (512 bytes - 256 wide chars)
-            name = data.get('name', 'Foundry VTT User')[:255]
-            name_wide = name.encode('utf-16le')[:510]  # Leave room for null terminator
-            binary_data[offset:offset+len(name_wide)] = name_wide
-            offset += 512
-            
-            # Camera position (12 bytes - 3 floats)
-            cam_pos = data.get('fCameraPosition', pos)
-            for i in range(3):
-                struct.pack_into('<f', binary_data, offset, cam_pos[i])
-                offset += 4
-                
-            # Camera front (12 bytes - 3 floats)
-            cam_front = data.get('fCameraFront', front)
-            for i in range(3):
-                struct.pack_into('<f', binary_data, offset, cam_front[i])
-                offset += 4
-                
-            # Camera top (12 bytes - 3 floats)
-            cam_top = data.get('fCameraTop', top)
-            for i in range(3):
-                struct.pack_into('<f', binary_data, offset, cam_top[i])
-                offset += 4
-            
-            # Identity (512 bytes - 256 wide chars)
-            identity = data.get('identity', '{}')[:255]
-            identity_wide = identity.encode('utf-16le')[:510]
-            binary_data[offset:offset+len(identity_wide)] = identity_wide
-            offset += 512
-            
-            # Context length (4 bytes)
-            context = data.get('context', [])
+            # uiTick must change on every update for Mumble to treat the
+            # data as live, so keep the counter on the Python side
+            # (wrapped to 32 bits to stay packable as '<I')
+            self._tick = (self._tick + 1) & 0xFFFFFFFF
+
+            # 'or' falls back to the shared tuples for missing (or empty)
+            # fields without allocating a fresh default list per message
+            version = data.get('uiVersion', 4)
+            pos = data.get('fAvatarPosition') or _DEF_POS
+            front = data.get('fAvatarFront') or _DEF_FRONT
+            top = data.get('fAvatarTop') or _DEF_TOP
+            cam_pos = data.get('fCameraPosition') or pos
+            cam_front = data.get('fCameraFront') or front
+            cam_top = data.get('fCameraTop') or top
+            name = (data.get('name') or 'Foundry VTT User')[:255]
+            identity = (data.get('identity') or '{}')[:255]
+            context = data.get('context') or b''
+            description = (data.get('description') or 'Foundry VTT')[:341]
+
+            mv = self._mm_view
+
+            # Idle tokens send the same position for many consecutive
+            # frames; when nothing changed, just bump uiTick in place
+            sig = (version, pos, front, top, cam_pos, cam_front, cam_top,
+                   name, identity, context, description)
+            if sig == self._last_sig:
+                _TICK.pack_into(mv, 4, self._tick)
+                if self._do_flush and not self._is_windows:
+                    self.mumble_memory.flush()
+                return
+            self._last_sig = sig
+
+            # The view is the mapping itself, so each field lands in shared
+            # memory as it is packed; the numeric fields are fully
+            # overwritten below, so only the variable-length string regions
+            # need re-zeroing
+            mv[44:556] = _ZEROS[:512]     # name
+            mv[592:1104] = _ZEROS[:512]   # identity
+            mv[1108:1364] = _ZEROS[:256]  # context
+            mv[1364:2048] = _ZEROS[:684]  # description
+
+            # uiVersion, uiTick and the three avatar vectors (offset 0)
+            _HEADER.pack_into(
+                mv, 0, version, self._tick,
+                pos[0], pos[1], pos[2],
+                front[0], front[1], front[2],
+                top[0], top[1], top[2])
+
+            # Name (512 bytes - 256 wide chars, offset 44)
+            name_wide = self._wenc('name', name, 510)  # Leave room for null terminator
+            mv[44:44+len(name_wide)] = name_wide
+
+            # Camera position/front/top (36 bytes - 9 floats, offset 556)
+            _CAM.pack_into(
+                mv, 556,
+                cam_pos[0], cam_pos[1], cam_pos[2],
+                cam_front[0], cam_front[1], cam_front[2],
+                cam_top[0], cam_top[1], cam_top[2])
+
+            # Identity (512 bytes - 256 wide chars, offset 592)
+            identity_wide = self._wenc('identity', identity, 510)
+            mv[592:592+len(identity_wide)] = identity_wide
+
+            # Context length (4 bytes, offset 1104)
             context_len = min(len(context), 256)
-            struct.pack_into('<I', binary_data, offset, context_len)
-            offset += 4
-            
-            # Context data (256 bytes)
+            _CTXLEN.pack_into(mv, 1104, context_len)
+
+            # Context data (256 bytes, offset 1108)
             if context:
-                context_bytes = bytes(context[:256])
-                binary_data[offset:offset+len(context_bytes)] = context_bytes
-            offset += 256
-            
-            # Description (4096 bytes - 2048 wide chars)
-            description = data.get('description', 'Foundry VTT')[:2047]
-            desc_wide = description.encode('utf-16le')[:4094]
-            binary_data[offset:offset+len(desc_wide)] = desc_wide
+                if isinstance(context, (bytes, bytearray)):
+                    context_bytes = context[:256]
+                else:
+                    # list of ints from JSON
+                    context_bytes = bytes(context[:256])
+                mv[1108:1108+len(context_bytes)] = context_bytes
+
+            # Description (wide chars, offset 1364; truncated to fit the 2KB mapping)
+            desc_wide = self._wenc('description', description, 682)
+            mv[1364:1364+len(desc_wide)] = desc_wide
             
-            # Write to memory
-            if platform.system() == "Windows":
-                ctypes.memmove(self.mumble_memory, binary_data, len(binary_data))
-            else:
-                self.mumble_memory.seek(0)
-                self.mumble_memory.write(binary_data)
+            if self._do_flush and not self._is_windows:
+                # Mumble polls the coherent mapping, so an msync per tick is
+                # normally unnecessary; fence only when explicitly requested
                 self.mumble_memory.flush()
                 
         except Exception as e:
             logger.error(f"Failed to update Mumble Link: {e}")
 
+    async def _flush_pending(self):
+        """Write the most recent queued update to the Link memory at ~60Hz.
+
+        Mumble only samples uiTick at ~50Hz, so writing every message from
+        a fast client is wasted work; keeping just the latest one coalesces
+        bursts into a single write per interval.
+        """
+        while True:
+            await asyncio.sleep(1 / 60)
+            pending = self._pending
+            if pending is not None:
+                self._pending = None
+                self.update_mumble_link(pending)
+
     async def handle_client(self, websocket, path):
         """Handle WebSocket client connections from FVTT"""
         logger.info(f"New client connected: {websocket.remote_address}")
-        self.clients.add(websocket)
-        
+
         try:
             async for message in websocket:
                 try:
-                    data = json.loads(message)
-                    self.update_mumble_link(data)
-                    logger.debug(f"Updated Mumble Link with: {data.get('name', 'Unknown')}")
-                    
-                except json.JSONDecodeError:
+                    data = _loads(message)
+                    self._pending = data
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Queued Mumble Link update for: %s",
+                                     data.get('name', 'Unknown'))
+
+                except ValueError:
+                    # covers json.JSONDecodeError and orjson.JSONDecodeError
                     logger.warning(f"Invalid JSON received: {message}")
                 except Exception as e:
                     logger.error(f"Error processing message: {e}")
                     
         except websockets.exceptions.ConnectionClosed:
             logger.info("Client disconnected")
-        finally:
-            self.clients.remove(websocket)
 
     async def start_server(self, host='localhost', port=23456):
         """Start the WebSocket server"""
@@ -226,9 +315,17 @@ class MumbleLinkHelper:
             
         logger.info(f"Starting Mumble Link Helper server on {host}:{port}")
         
-        async with websockets.serve(self.handle_client, host, port):
+        # Position updates are tiny JSON blobs: permessage-deflate only
+        # burns CPU on them, and the small max_size/max_queue bounds keep a
+        # misbehaving client from queueing up memory
+        async with websockets.serve(self.handle_client, host, port,
+                                    compression=None, max_size=4096, max_queue=16):
             logger.info("Server started. Waiting for connections from Foundry VTT...")
-            await asyncio.Future()  # Run forever
+            flusher = asyncio.create_task(self._flush_pending())
+            try:
+                await asyncio.Future()  # Run forever
+            finally:
+                flusher.cancel()
 
 def main():
     """Main entry point"""
@@ -238,14 +335,24 @@ def main():
     parser.add_argument('--host', default='localhost', help='Host to bind to')
     parser.add_argument('--port', type=int, default=23456, help='Port to bind to')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    parser.add_argument('--flush', action='store_true',
+                        help='msync the mapping after every update (normally unnecessary)')
     
     args = parser.parse_args()
     
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
     
-    helper = MumbleLinkHelper()
-    
+    helper = MumbleLinkHelper(flush=args.flush)
+
+    # uvloop is markedly faster than the default loop for websockets
+    # workloads; not available on Windows, so fall through quietly
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     try:
         asyncio.run(helper.start_server(args.host, args.port))
     except KeyboardInterrupt: